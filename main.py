@@ -1,23 +1,47 @@
 import flet as ft
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errors
 import hashlib
+import hmac
 from datetime import date, datetime
 import os
+import sys
+import signal
+import time
 import threading
+import select
 import io
 import base64
+import functools
+import itertools
+import atexit
+import contextlib
+import contextvars
+import re
+import importlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 
 # --- CAPA 0: DEPENDENCIAS EXTERNAS ---
 print("--- Oñepyrũ aplicación v8.1 (Smart Auto-Presente) ---", flush=True)
 
-try:
-    import xlsxwriter
+# XlsxWriter solo se usa al exportar: al arrancar se verifica que esté, sin importarlo
+if importlib.util.find_spec("xlsxwriter"):
     print("✅ Librería XlsxWriter detectada.")
-except ImportError:
-    xlsxwriter = None
+else:
     print("⚠️ URGENTE: XlsxWriter NO está instalado.")
 
+@functools.lru_cache(maxsize=None)
+def load_xlsxwriter():
+    # Import diferido al primer reporte; None si la librería no está
+    try:
+        return importlib.import_module("xlsxwriter")
+    except ImportError:
+        return None
+
 # --- CONFIGURACIÓN UI ---
 THEME = {
     "primary": "indigo",
@@ -31,6 +55,12 @@ THEME = {
     "text": "bluegrey900"
 }
 
+# Códigos de asistencia del selector. Los ft.dropdown.Option no se pueden compartir entre
+# dropdowns (cada control tiene un único padre), así que se comparte la tupla de códigos.
+STATUS_CODES = ("P", "T", "A", "J", "S", "N")
+# Días hábiles para TPP; el índice coincide con date.weekday() y con lo guardado en tpp_dias
+DIAS_SEMANA = ("Lun", "Mar", "Mié", "Jue", "Vie")
+
 # ==============================================================================
 # CAPA 1: UTILIDADES Y SEGURIDAD
 # ==============================================================================
@@ -53,6 +83,31 @@ class UIHelper:
             expand=expand
         )
 
+    @staticmethod
+    def current_user(page: ft.Page):
+        # Usuario de la sesión memoizado en la página; set_user lo invalida en login/logout
+        user = getattr(page, "_user_cache", None)
+        if user is None:
+            user = page._user_cache = page.session.get("user")
+        return user
+
+    @staticmethod
+    def set_user(page: ft.Page, user):
+        if user: page.session.set("user", user)
+        elif page.session.contains_key("user"): page.session.remove("user")
+        page._user_cache = user
+
+    @staticmethod
+    def sync_controls(controls, cache, items, key, build):
+        # Reconciliación por clave: reutiliza los controles existentes y solo construye/quita los que cambiaron.
+        # Devuelve False si la lista quedó idéntica (el llamador puede ahorrarse el page.update()).
+        keys = [key(it) for it in items]
+        if keys == list(cache) and len(controls) == len(keys): return False
+        fresh = {k: (cache[k] if k in cache else build(it)) for k, it in zip(keys, items)}
+        cache.clear(); cache.update(fresh)
+        controls[:] = [fresh[k] for k in keys]
+        return True
+
     @staticmethod
     def create_header(title, subtitle="", leading=None, actions=None):
         sub_control = ft.Text(subtitle, size=12, color="white70") if isinstance(subtitle, str) and subtitle else (subtitle if isinstance(subtitle, ft.Control) else ft.Container())
@@ -73,118 +128,382 @@ class UIHelper:
         )
 
 class Security:
+    # Formato guardado: pbkdf2_sha256$<iteraciones>$<sal hex>$<hash hex>
+    PREFIX = "pbkdf2_sha256"
+    ITERATIONS = 100_000
+
     @staticmethod
-    def hash_password(password: str) -> str:
-        return hashlib.sha256(password.encode()).hexdigest()
+    def hash_password(password: str, salt: bytes = None) -> str:
+        salt_hex = (salt or os.urandom(16)).hex()
+        return f"{Security.PREFIX}${Security.ITERATIONS}${salt_hex}${Security._derive(password, salt_hex, Security.ITERATIONS)}"
+
+    @staticmethod
+    def _derive(password: str, salt_hex: str, iterations: int) -> str:
+        # PBKDF2 de hashlib corre sobre OpenSSL (SHA-NI cuando la CPU lo tiene)
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt_hex), iterations).hex()
+
+    @staticmethod
+    def verify_password(password: str, stored: str) -> bool:
+        if Security.needs_rehash(stored):
+            # Hashes heredados: SHA-256 sin sal
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        try:
+            _, iterations, salt_hex, digest = stored.split("$")
+            return hmac.compare_digest(Security._derive(password, salt_hex, int(iterations)), digest)
+        except ValueError:
+            return False
+
+    @staticmethod
+    def needs_rehash(stored: str) -> bool:
+        return not stored.startswith(Security.PREFIX + "$")
+
+# Calculados una sola vez al importar
+ADMIN_SEED_HASH = Security.hash_password("admin")
+_DUMMY_HASH = Security.hash_password(os.urandom(16).hex())  # para usuarios inexistentes (tiempo constante)
+
+@functools.lru_cache(maxsize=64)
+def parse_date(value: str):
+    # (fecha, día de la semana); el selector re-parsea el mismo texto en cada recarga
+    d = date.fromisoformat(value)
+    return d, d.weekday()
 
 # ==============================================================================
 # CAPA 2: GESTIÓN DE BASE DE DATOS
 # ==============================================================================
 
+class PreparingConnection(psycopg2.extensions.connection):
+    # Recuerda qué sentencias ya se prepararon en esta sesión (PREPARE vive lo que la conexión)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.stale = set()  # preparadas con un plan que ya no sirve: DEALLOCATE antes de re-preparar
+
 class DatabaseManager:
-    _instance = None
-    _lock = threading.Lock()
-
-    def __new__(cls):
-        if cls._instance is None:
-            with cls._lock:
-                if cls._instance is None:
-                    cls._instance = super(DatabaseManager, cls).__new__(cls)
-                    cls._instance._init_db_structure()
-        return cls._instance
-
-    def get_connection(self):
+    # Instancia única: se construye una sola vez al importar el módulo (ver `db` abajo)
+    # Conexión compartida por todas las consultas de un mismo request (ver request_scope)
+    _request_conn = contextvars.ContextVar("request_conn", default=None)
+    _POOL_WAIT = 30  # segundos esperando una conexión libre antes de dar el error
+
+    def __init__(self):
+        self._listeners = {}
+        # Se incrementa con cada escritura de este proceso y con los avisos NOTIFY de otros
+        # (toda escritura que muestran las vistas cacheadas avisa). Invalida las vistas cacheadas.
+        self.data_version = 0
+        self.read_errors = 0  # lecturas fallidas: un resultado vacío puede ser un error, no "no hay datos"
+        self._counter_lock = threading.Lock()
+        self._conn_args, self._conn_kwargs = self._connection_params()
+        self._pool_min = int(os.environ.get('DB_POOL_MIN', 2))
+        self._pool_max = int(os.environ.get('DB_POOL_MAX', 10))
+        # getconn() no espera: con el pool agotado lanza PoolError. El semáforo hace que se espere turno.
+        self._pool_slots = threading.BoundedSemaphore(self._pool_max)
+        self._pool_lock = threading.Lock()  # si el pool falló al arrancar, un solo hilo lo vuelve a crear
+        self._pool = self._create_pool()
+        self._listener_started = False
+        self.ready = False  # esquema verificado: recién ahí tiene sentido escuchar avisos
+        self._init_db_structure()
+
+    # --- Invalidación de cachés entre procesos (LISTEN/NOTIFY) ---
+    def subscribe(self, topic, callback):
+        self._listeners.setdefault(topic, []).append(callback)
+
+    def touch(self):
+        # Se llama desde la UI, el hilo escritor y el listener: sin lock se perderían incrementos
+        with self._counter_lock:
+            self.data_version += 1
+
+    def _read_failed(self):
+        with self._counter_lock:
+            self.read_errors += 1
+
+    def _dispatch(self, topic=None):
+        self.touch()  # cambios hechos por otro proceso
+        for t, callbacks in self._listeners.items():
+            if topic is None or t == topic:
+                for cb in callbacks: cb()
+
+    def start_listener(self):
+        # main() corre una vez por sesión: el hilo se arranca solo la primera vez
+        with self._counter_lock:
+            if self._listener_started: return
+            self._listener_started = True
+        threading.Thread(target=self._listen_loop, daemon=True, name="db-listener").start()
+
+    def _listen_loop(self):
+        espera = 5
+        while True:
+            # Conexión dedicada, fuera del pool. Sin DB se reintenta cada vez más espaciado
+            # y el error se informa una sola vez por corte, no en cada reintento.
+            conn = self._connect(quiet=espera > 5)
+            if not conn:
+                espera = min(espera * 2, 300)
+            else:
+                espera = 5
+                try:
+                    conn.autocommit = True
+                    with conn.cursor() as cur: cur.execute("LISTEN cache_invalidate")
+                    self._dispatch()  # pudimos perdernos avisos mientras estábamos desconectados
+                    while True:
+                        if select.select([conn], [], [], 60) == ([], [], []): continue
+                        conn.poll()
+                        while conn.notifies:
+                            self._dispatch(conn.notifies.pop(0).payload)
+                except Exception as e:
+                    print(f"❌ Error Listener DB: {e}")
+                finally: conn.close()
+            time.sleep(espera)
+
+    @staticmethod
+    def _connection_params():
+        # Se resuelve una sola vez: URL de Render (con SSL) o variables sueltas para desarrollo local
         database_url = os.environ.get('DATABASE_URL')
+        if database_url:
+            if database_url.startswith('postgres://'):
+                database_url = database_url.replace('postgres://', 'postgresql://', 1)
+            return (database_url,), {'sslmode': 'require', 'connection_factory': PreparingConnection}
+        return (), {
+            'connection_factory': PreparingConnection,
+            'host': os.environ.get('DB_HOST', 'localhost'),
+            'port': os.environ.get('DB_PORT', '5432'),
+            'database': os.environ.get('DB_NAME', 'postgres'),
+            'user': os.environ.get('DB_USER', 'postgres'),
+            'password': os.environ.get('DB_PASSWORD', 'password')
+        }
+
+    def _connect(self, quiet=False):
         try:
-            if database_url:
-                if database_url.startswith('postgres://'):
-                    database_url = database_url.replace('postgres://', 'postgresql://', 1)
-                return psycopg2.connect(database_url, sslmode='require')
-            else:
-                return psycopg2.connect(
-                    host=os.environ.get('DB_HOST', 'localhost'),
-                    port=os.environ.get('DB_PORT', '5432'),
-                    database=os.environ.get('DB_NAME', 'postgres'),
-                    user=os.environ.get('DB_USER', 'postgres'),
-                    password=os.environ.get('DB_PASSWORD', 'password')
-                )
+            return psycopg2.connect(*self._conn_args, **self._conn_kwargs)
+        except Exception as e:
+            if not quiet: print(f"❌ Error conexión DB: {e}")
+            return None
+
+    def _create_pool(self):
+        # El pool conserva hasta `minconn` conexiones ociosas; el resto se cierra al devolverse
+        try:
+            return psycopg2.pool.ThreadedConnectionPool(self._pool_min, self._pool_max, *self._conn_args, **self._conn_kwargs)
         except Exception as e:
+            print(f"❌ Error pool DB: {e}")
+            return None
+
+    def get_connection(self, readonly=False):
+        conn = self._checkout()
+        # Lecturas en autocommit: sin BEGIN implícito ni ROLLBACK al devolverla (dos round trips menos)
+        if readonly and conn and not conn.closed and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.autocommit = True
+        return conn
+
+    def _checkout(self):
+        shared = self._request_conn.get()
+        if shared is not None and not shared.closed: return shared
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None: self._pool = self._create_pool()
+            if self._pool is None: return None
+        if not self._pool_slots.acquire(timeout=self._POOL_WAIT):
+            print("❌ Error conexión DB: pool agotado")
+            return None
+        try:
+            return self._pool.getconn()
+        except Exception as e:
+            self._pool_slots.release()
             print(f"❌ Error conexión DB: {e}")
             return None
 
+    def release(self, conn):
+        if not conn.closed and conn.autocommit: conn.autocommit = False  # las escrituras siguen siendo transaccionales
+        if conn is self._request_conn.get():
+            # La del request vuelve al pool al cerrar el scope; acá solo se limpia un error
+            if not conn.closed and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                conn.rollback()
+            return
+        # Las conexiones rotas se descartan en lugar de volver al pool
+        try:
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._pool_slots.release()
+
+    @contextlib.contextmanager
+    def request_scope(self):
+        # Las consultas anidadas dentro del bloque (mismo hilo/contexto) comparten una sola conexión
+        if self._request_conn.get() is not None:
+            yield; return
+        conn = self.get_connection()
+        token = self._request_conn.set(conn)
+        try:
+            yield
+        finally:
+            self._request_conn.reset(token)
+            if conn: self.release(conn)  # el pool hace rollback de lo que haya quedado abierto
+
+    def close(self):
+        if self._pool is not None and not self._pool.closed:
+            self._pool.closeall()
+
+    @staticmethod
+    def _run(conn, cur, query, params, prepare=None):
+        # Con `prepare`, la sentencia se prepara una vez por conexión y luego solo se hace EXECUTE
+        if not prepare:
+            return cur.execute(query, params)
+        try:
+            if prepare not in conn.prepared:
+                if prepare in conn.stale:
+                    cur.execute(f"DEALLOCATE {prepare}")
+                    conn.stale.discard(prepare)
+                n = itertools.count(1)
+                cur.execute(f"PREPARE {prepare} AS " + re.sub(r"%s", lambda _: f"${next(n)}", query))
+                conn.prepared.add(prepare)
+            cur.execute(f"EXECUTE {prepare} ({', '.join(['%s'] * len(params))})" if params else f"EXECUTE {prepare}", params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            conn.prepared.discard(prepare)  # el servidor la perdió: se vuelve a preparar la próxima vez
+            raise
+        except psycopg2.errors.FeatureNotSupported:
+            # "cached plan must not change result type": cambió una tabla después del PREPARE
+            if prepare in conn.prepared:
+                conn.prepared.discard(prepare)
+                conn.stale.add(prepare)
+            raise
+
     def _init_db_structure(self):
         conn = self.get_connection()
         if not conn: return
         try:
+            # Todo el esquema en un solo envío (una transacción, un round trip al arrancar)
             with conn.cursor() as cur:
-                cur.execute("CREATE TABLE IF NOT EXISTS Usuarios (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, role TEXT)")
-                cur.execute("CREATE TABLE IF NOT EXISTS Ciclos (id SERIAL PRIMARY KEY, nombre TEXT UNIQUE, activo INTEGER DEFAULT 0)")
-                cur.execute("CREATE TABLE IF NOT EXISTS Cursos (id SERIAL PRIMARY KEY, nombre TEXT, ciclo_id INTEGER REFERENCES Ciclos(id) ON DELETE CASCADE)")
-                cur.execute("CREATE TABLE IF NOT EXISTS Usuario_Cursos (usuario_id INTEGER REFERENCES Usuarios(id) ON DELETE CASCADE, curso_id INTEGER REFERENCES Cursos(id) ON DELETE CASCADE, PRIMARY KEY (usuario_id, curso_id))")
-
-                cur.execute("""CREATE TABLE IF NOT EXISTS Alumnos (
-                    id SERIAL PRIMARY KEY, 
-                    curso_id INTEGER REFERENCES Cursos(id) ON DELETE CASCADE, 
-                    nombre TEXT, dni TEXT, observaciones TEXT, 
-                    tutor_nombre TEXT, tutor_telefono TEXT, 
-                    tpp INTEGER DEFAULT 0, tpp_dias TEXT, 
-                    UNIQUE(curso_id, nombre)
-                )""")
-                
-                cur.execute("CREATE TABLE IF NOT EXISTS Asistencia (id SERIAL PRIMARY KEY, alumno_id INTEGER REFERENCES Alumnos(id) ON DELETE CASCADE, fecha TEXT, status TEXT, UNIQUE(alumno_id, fecha))")
-                cur.execute("CREATE TABLE IF NOT EXISTS Requisitos (id SERIAL PRIMARY KEY, curso_id INTEGER REFERENCES Cursos(id) ON DELETE CASCADE, descripcion TEXT)")
-                cur.execute("CREATE TABLE IF NOT EXISTS Documentacion_Alumno (requisito_id INTEGER REFERENCES Requisitos(id) ON DELETE CASCADE, alumno_id INTEGER REFERENCES Alumnos(id) ON DELETE CASCADE, entregado INTEGER DEFAULT 0, PRIMARY KEY (requisito_id, alumno_id))")
-
-                cur.execute("SELECT COUNT(*) FROM Usuarios")
-                if cur.fetchone()[0] == 0:
-                    cur.execute("INSERT INTO Usuarios (username, password, role) VALUES (%s, %s, %s)", ("admin", Security.hash_password("admin"), "admin"))
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS Usuarios (id SERIAL PRIMARY KEY, username TEXT UNIQUE, password TEXT, role TEXT);
+                    CREATE TABLE IF NOT EXISTS Ciclos (id SERIAL PRIMARY KEY, nombre TEXT UNIQUE, activo INTEGER DEFAULT 0);
+                    CREATE TABLE IF NOT EXISTS Cursos (id SERIAL PRIMARY KEY, nombre TEXT, ciclo_id INTEGER REFERENCES Ciclos(id) ON DELETE CASCADE);
+                    CREATE TABLE IF NOT EXISTS Usuario_Cursos (usuario_id INTEGER REFERENCES Usuarios(id) ON DELETE CASCADE, curso_id INTEGER REFERENCES Cursos(id) ON DELETE CASCADE, PRIMARY KEY (usuario_id, curso_id));
+                    CREATE TABLE IF NOT EXISTS Alumnos (
+                        id SERIAL PRIMARY KEY, 
+                        curso_id INTEGER REFERENCES Cursos(id) ON DELETE CASCADE, 
+                        nombre TEXT, dni TEXT, observaciones TEXT, 
+                        tutor_nombre TEXT, tutor_telefono TEXT, 
+                        tpp INTEGER DEFAULT 0, tpp_dias TEXT, 
+                        UNIQUE(curso_id, nombre)
+                    );
+                    -- Bases creadas antes de TPP: migración idempotente, sin try/rollback
+                    ALTER TABLE Alumnos ADD COLUMN IF NOT EXISTS tpp INTEGER DEFAULT 0;
+                    ALTER TABLE Alumnos ADD COLUMN IF NOT EXISTS tpp_dias TEXT;
+                    CREATE TABLE IF NOT EXISTS Asistencia (id SERIAL PRIMARY KEY, alumno_id INTEGER REFERENCES Alumnos(id) ON DELETE CASCADE, fecha TEXT, status TEXT, UNIQUE(alumno_id, fecha));
+                    CREATE TABLE IF NOT EXISTS Requisitos (id SERIAL PRIMARY KEY, curso_id INTEGER REFERENCES Cursos(id) ON DELETE CASCADE, descripcion TEXT);
+                    CREATE TABLE IF NOT EXISTS Documentacion_Alumno (requisito_id INTEGER REFERENCES Requisitos(id) ON DELETE CASCADE, alumno_id INTEGER REFERENCES Alumnos(id) ON DELETE CASCADE, entregado INTEGER DEFAULT 0, PRIMARY KEY (requisito_id, alumno_id));
+
+                    -- Índices para los predicados calientes. (alumno_id, fecha) y (curso_id, nombre)
+                    -- ya están cubiertos por las restricciones UNIQUE de Asistencia y Alumnos.
+                    -- (ciclo_id, nombre): filtra y entrega ya ordenado el listado de cursos (sin Sort)
+                    CREATE INDEX IF NOT EXISTS ix_cursos_ciclo_nombre ON Cursos(ciclo_id, nombre);
+
+                    -- A lo sumo un ciclo activo, garantizado por la DB (índice único parcial)
+                    UPDATE Ciclos SET activo = 0 WHERE activo = 1 AND id <> (SELECT MAX(id) FROM Ciclos WHERE activo = 1);
+                    CREATE UNIQUE INDEX IF NOT EXISTS ix_ciclo_unico_activo ON Ciclos(activo) WHERE activo = 1;
+
+                    -- Semilla admin solo si la tabla está vacía, sin consulta previa de conteo
+                    INSERT INTO Usuarios (username, password, role) SELECT %s, %s, %s WHERE NOT EXISTS (SELECT 1 FROM Usuarios);
+                """, ("admin", ADMIN_SEED_HASH, "admin"))
             conn.commit()
+            self.ready = True
             print("✅ DB PostgreSQL Estructura OK.")
         except Exception as e:
             print(f"❌ Error Init DB: {e}")
         finally:
-            conn.close()
+            self.release(conn)
 
-    def fetch_all(self, query, params=()):
-        conn = self.get_connection()
-        if not conn: return []
+    def fetch_all(self, query, params=(), prepare=None):
+        conn = self.get_connection(readonly=True)
+        if not conn: self._read_failed(); return []
         try:
             with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query, params)
-                return [dict(row) for row in cur.fetchall()]
+                self._run(conn, cur, query, params, prepare)
+                # RealDictRow ya es un dict: no hace falta copiar cada fila
+                return cur.fetchall()
         except Exception as e:
             print(f"❌ Error Fetch All: {e}")
+            self._read_failed()
             return []
-        finally: conn.close()
+        finally: self.release(conn)
 
-    def fetch_one(self, query, params=()):
-        conn = self.get_connection()
-        if not conn: return None
+    def fetch_one(self, query, params=(), prepare=None):
+        conn = self.get_connection(readonly=True)
+        if not conn: self._read_failed(); return None
         try:
             with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(query, params)
-                row = cur.fetchone()
-                return dict(row) if row else None
+                self._run(conn, cur, query, params, prepare)
+                return cur.fetchone()
         except Exception as e:
             print(f"❌ Error Fetch One: {e}")
+            self._read_failed()
             return None
-        finally: conn.close()
+        finally: self.release(conn)
+
+    def fetch_rows(self, query, params=(), prepare=None):
+        # Cursor de tuplas para consultas calientes: sin armar un dict por fila
+        conn = self.get_connection(readonly=True)
+        if not conn: self._read_failed(); return []
+        try:
+            with conn.cursor() as cur:
+                self._run(conn, cur, query, params, prepare)
+                return cur.fetchall()
+        except Exception as e:
+            print(f"❌ Error Fetch Rows: {e}")
+            self._read_failed()
+            return []
+        finally: self.release(conn)
+
+    _stream_ids = itertools.count(1)
 
-    def execute(self, query, params=()):
+    def stream_rows(self, query, params=(), itersize=2000):
+        # Cursor con nombre (del lado del servidor): las filas llegan de a `itersize`, nunca todo el resultado junto.
+        # Necesita transacción, por eso no usa la conexión de solo lectura en autocommit.
+        conn = self.get_connection()
+        if not conn: raise psycopg2.OperationalError("sin conexión a la base de datos")
+        try:
+            with conn.cursor(name=f"stream_{next(self._stream_ids)}") as cur:
+                cur.itersize = itersize
+                cur.execute(query, params)
+                yield from cur
+        except Exception as e:
+            # Se relanza: cortar en silencio entregaría un reporte truncado como si estuviera completo
+            print(f"❌ Error Stream: {e}")
+            raise
+        finally: self.release(conn)
+
+    def execute(self, query, params=(), prepare=None):
         conn = self.get_connection()
         if not conn: return False
         try:
             with conn.cursor() as cur:
-                cur.execute(query, params)
+                self._run(conn, cur, query, params, prepare)
             conn.commit()
+            self.touch()
             return True
         except Exception as e:
             print(f"❌ Error Execute: {e}")
             conn.rollback()
             return False
-        finally: conn.close()
+        finally: self.release(conn)
+
+    def execute_values(self, query, rows, page_size=500, strict=False, notify=None):
+        # Inserción masiva: un único INSERT ... VALUES (...),(...) por página.
+        # strict: relanza el error (tras el rollback) para distinguir datos inválidos de fallas de conexión
+        # notify: tema a avisar a los otros procesos en la misma transacción
+        conn = self.get_connection()
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, query, rows, page_size=page_size)
+                if notify: cur.execute("NOTIFY cache_invalidate, %s", (notify,))
+            conn.commit()
+            self.touch()
+            return True
+        except Exception as e:
+            print(f"❌ Error Execute Values: {e}")
+            if not conn.closed: conn.rollback()
+            if strict: raise
+            return False
+        finally: self.release(conn)
 
 db = DatabaseManager()
+atexit.register(db.close)
 
 # ==============================================================================
 # CAPA 3: SERVICIOS DE NEGOCIO
@@ -193,12 +512,17 @@ db = DatabaseManager()
 class UserService:
     @staticmethod
     def login(username, password):
-        user = db.fetch_one("SELECT * FROM Usuarios WHERE username = %s", (username,))
-        if user and user['password'] == Security.hash_password(password):
-            return user
-        return None
+        user = db.fetch_one("SELECT id, username, role, password FROM Usuarios WHERE username = %s", (username,), prepare="q_login")
+        # Se verifica siempre una vez, en tiempo constante, exista o no el usuario
+        stored = (user['password'] or "") if user else _DUMMY_HASH
+        if not (Security.verify_password(password, stored) and user): return None
+        if Security.needs_rehash(stored):
+            # Migración transparente del hash SHA-256 heredado a PBKDF2
+            db.execute("UPDATE Usuarios SET password = %s WHERE id = %s", (Security.hash_password(password), user['id']))
+        user.pop('password')  # el hash no viaja a la sesión
+        return user
     @staticmethod
-    def get_users(): return db.fetch_all("SELECT * FROM Usuarios ORDER BY username")
+    def get_users(): return db.fetch_all("SELECT id, username, role FROM Usuarios ORDER BY username")
     @staticmethod
     def add_user(u, p, r): return db.execute("INSERT INTO Usuarios (username, password, role) VALUES (%s, %s, %s)", (u, Security.hash_password(p), r))
     @staticmethod
@@ -212,81 +536,167 @@ class UserService:
     @staticmethod
     def toggle_user_curso(uid, cid, assign):
         if assign:
-            db.execute("INSERT INTO Usuario_Cursos (usuario_id, curso_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (uid, cid))
+            db.execute("INSERT INTO Usuario_Cursos (usuario_id, curso_id) VALUES (%s, %s) ON CONFLICT DO NOTHING; NOTIFY cache_invalidate, 'cursos'", (uid, cid))
         else:
-            db.execute("DELETE FROM Usuario_Cursos WHERE usuario_id = %s AND curso_id = %s", (uid, cid))
+            db.execute("DELETE FROM Usuario_Cursos WHERE usuario_id = %s AND curso_id = %s; NOTIFY cache_invalidate, 'cursos'", (uid, cid))
+        SchoolService.invalidate_cursos()
 
 class SchoolService:
+    # El ciclo activo cambia pocas veces al año: se cachea (valor, vencimiento)
+    _CICLO_TTL = 30
+    _ciclo_cache = (None, 0.0)
+    _cursos_cache = {}
+
+    @staticmethod
+    def get_ciclos(): return db.fetch_all("SELECT id, nombre, activo FROM Ciclos ORDER BY nombre DESC")
+
     @staticmethod
-    def get_ciclos(): return db.fetch_all("SELECT * FROM Ciclos ORDER BY nombre DESC")
+    def get_ciclo_activo():
+        ciclo, expira = SchoolService._ciclo_cache
+        if time.monotonic() < expira: return ciclo
+        errores = db.read_errors
+        ciclo = db.fetch_one("SELECT id, nombre FROM Ciclos WHERE activo = 1 LIMIT 1")
+        # Un None por fallo de la DB no se cachea: solo "no hay ciclo activo" de verdad
+        if db.read_errors == errores:
+            SchoolService._ciclo_cache = (ciclo, time.monotonic() + SchoolService._CICLO_TTL)
+        return ciclo
+
     @staticmethod
-    def get_ciclo_activo(): return db.fetch_one("SELECT * FROM Ciclos WHERE activo = 1 LIMIT 1")
+    def invalidate_ciclo(): SchoolService._ciclo_cache = (None, 0.0)
     
     @staticmethod
     def add_ciclo(nombre):
         conn = db.get_connection()
+        if not conn: return False
         try:
             with conn.cursor() as cur:
-                cur.execute("UPDATE Ciclos SET activo = 0")
-                cur.execute("INSERT INTO Ciclos (nombre, activo) VALUES (%s, 1)", (nombre,))
-            conn.commit(); return True
+                # Primero desactivar (el índice único no admite dos activos a la vez); un solo envío
+                cur.execute("UPDATE Ciclos SET activo = 0 WHERE activo = 1; INSERT INTO Ciclos (nombre, activo) VALUES (%s, 1); NOTIFY cache_invalidate, 'ciclo'", (nombre,))
+            conn.commit(); db.touch(); return True
         except: conn.rollback(); return False
-        finally: conn.close()
+        finally: db.release(conn); SchoolService.invalidate_ciclo()
 
     @staticmethod
     def activar_ciclo(cid):
         conn = db.get_connection()
+        if not conn: return False
         try:
             with conn.cursor() as cur:
-                cur.execute("UPDATE Ciclos SET activo = 0")
-                cur.execute("UPDATE Ciclos SET activo = 1 WHERE id = %s", (int(cid),))
-            conn.commit()
-        finally: conn.close()
+                cur.execute("UPDATE Ciclos SET activo = 0 WHERE activo = 1; UPDATE Ciclos SET activo = 1 WHERE id = %s; NOTIFY cache_invalidate, 'ciclo'", (int(cid),))
+            conn.commit(); db.touch()
+        finally: db.release(conn); SchoolService.invalidate_ciclo()
     
     @staticmethod
-    def delete_ciclo(cid): return db.execute("DELETE FROM Ciclos WHERE id = %s", (cid,))
+    def delete_ciclo(cid):
+        ok = db.execute("DELETE FROM Ciclos WHERE id = %s; NOTIFY cache_invalidate, 'ciclo'", (cid,))
+        SchoolService.invalidate_ciclo()
+        return ok
 
     @staticmethod
     def get_cursos_activos(user_id=None, role=None):
         ciclo = SchoolService.get_ciclo_activo()
         if not ciclo: return []
+        # Misma caché con TTL, por (ciclo, usuario): al cambiar el ciclo cambia la clave
+        key = (ciclo['id'], None if role == 'admin' else user_id)
+        rows, expira = SchoolService._cursos_cache.get(key, (None, 0.0))
+        if time.monotonic() < expira: return rows
+        errores = db.read_errors
         if role == 'admin':
-            return db.fetch_all("SELECT * FROM Cursos WHERE ciclo_id = %s ORDER BY nombre", (ciclo['id'],))
+            rows = db.fetch_all("SELECT id, nombre FROM Cursos WHERE ciclo_id = %s ORDER BY nombre", (ciclo['id'],))
         else:
-            return db.fetch_all("SELECT c.* FROM Cursos c JOIN Usuario_Cursos uc ON c.id = uc.curso_id WHERE c.ciclo_id = %s AND uc.usuario_id = %s ORDER BY c.nombre", (ciclo['id'], user_id))
+            rows = db.fetch_all("SELECT c.id, c.nombre FROM Cursos c JOIN Usuario_Cursos uc ON c.id = uc.curso_id WHERE c.ciclo_id = %s AND uc.usuario_id = %s ORDER BY c.nombre", (ciclo['id'], user_id))
+        if db.read_errors == errores:  # una lista vacía por error no se cachea
+            SchoolService._cursos_cache[key] = (rows, time.monotonic() + SchoolService._CICLO_TTL)
+        return rows
+
+    @staticmethod
+    def invalidate_cursos(): SchoolService._cursos_cache.clear()
             
     @staticmethod
-    def get_cursos_all_active():
-        ciclo = SchoolService.get_ciclo_activo()
-        if not ciclo: return []
-        return db.fetch_all("SELECT * FROM Cursos WHERE ciclo_id = %s ORDER BY nombre", (ciclo['id'],))
+    def get_cursos_all_active(): return SchoolService.get_cursos_activos(role='admin')
+
+    @staticmethod
+    def get_alumnos_with_status(curso_id, fecha):
+        # Alumnos del curso con su estado del día (None si aún no se marcó)
+        rows = db.fetch_all("""
+            SELECT a.id, a.nombre, a.dni, a.tpp, a.tpp_dias, asi.status
+            FROM Alumnos a
+            LEFT JOIN Asistencia asi ON asi.alumno_id = a.id AND asi.fecha = %s
+            WHERE a.curso_id = %s
+            ORDER BY a.nombre
+        """, (fecha, curso_id), prepare="q_alumnos_dia")
+        for r in rows: r['tpp_mask'] = SchoolService.tpp_mask(r)
+        return rows
 
     @staticmethod
-    def get_alumnos(curso_id): return db.fetch_all("SELECT * FROM Alumnos WHERE curso_id = %s ORDER BY nombre", (curso_id,))
+    def tpp_mask(alumno):
+        # Bit n encendido = el alumno asiste el día de semana n. Sin TPP: todos (-1).
+        # El bit 7 nunca se enciende en TPP: se usa para fechas inválidas.
+        if alumno['tpp'] != 1 or not alumno['tpp_dias']: return -1
+        return SchoolService._dias_mask(alumno['tpp_dias'])
+
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def _dias_mask(tpp_dias):
+        # Pocas combinaciones distintas de días: se parsea cada texto una sola vez por proceso
+        return sum(1 << int(x) for x in tpp_dias.split(',') if x.isdigit())
     
     @staticmethod
     def get_alumno(aid):
         return db.fetch_one("""
-            SELECT a.*, c.nombre as curso_nombre, ci.nombre as ciclo_nombre, c.id as curso_id
+            SELECT a.id, a.curso_id, a.nombre, a.dni, a.observaciones, a.tutor_nombre, a.tutor_telefono, a.tpp, a.tpp_dias,
+                   c.nombre as curso_nombre, ci.nombre as ciclo_nombre
             FROM Alumnos a 
             JOIN Cursos c ON a.curso_id = c.id 
             JOIN Ciclos ci ON c.ciclo_id = ci.id
             WHERE a.id = %s
-        """, (aid,))
+        """, (aid,), prepare="q_alumno")
 
     @staticmethod
-    def add_curso(nombre, ciclo_id): return db.execute("INSERT INTO Cursos (nombre, ciclo_id) VALUES (%s, %s)", (nombre, ciclo_id))
+    def get_student_bundle(aid):
+        # Ficha + conteos + historial en un solo round trip; devuelve (alumno, stats, history)
+        row = db.fetch_one("""
+            SELECT a.id, a.curso_id, a.nombre, a.dni, a.observaciones, a.tutor_nombre, a.tutor_telefono, a.tpp, a.tpp_dias,
+                   c.nombre as curso_nombre, ci.nombre as ciclo_nombre,
+                   h.n_p, h.n_t, h.n_a, h.n_j, h.n_s, h.historial
+            FROM Alumnos a 
+            JOIN Cursos c ON a.curso_id = c.id 
+            JOIN Ciclos ci ON c.ciclo_id = ci.id
+            CROSS JOIN LATERAL (
+                SELECT COUNT(*) FILTER (WHERE status = 'P') AS n_p, COUNT(*) FILTER (WHERE status = 'T') AS n_t,
+                       COUNT(*) FILTER (WHERE status = 'A') AS n_a, COUNT(*) FILTER (WHERE status = 'J') AS n_j,
+                       COUNT(*) FILTER (WHERE status = 'S') AS n_s,
+                       COALESCE(json_agg(json_build_object('fecha', fecha, 'status', status) ORDER BY fecha DESC), '[]'::json) AS historial
+                FROM Asistencia WHERE alumno_id = a.id
+            ) h
+            WHERE a.id = %s
+        """, (aid,), prepare="q_student_bundle")
+        if not row: return None, None, []
+        stats = AttendanceService._stats_from_counts(*(row.pop(k) for k in ("n_p", "n_t", "n_a", "n_j", "n_s")))
+        return row, stats, row.pop("historial")
+
+    @staticmethod
+    def add_curso(nombre, ciclo_id):
+        ok = db.execute("INSERT INTO Cursos (nombre, ciclo_id) VALUES (%s, %s); NOTIFY cache_invalidate, 'cursos'", (nombre, ciclo_id))
+        SchoolService.invalidate_cursos()
+        return ok
     
     @staticmethod
     def add_alumno(data):
-        return db.execute("INSERT INTO Alumnos (curso_id, nombre, dni, observaciones, tutor_nombre, tutor_telefono, tpp, tpp_dias) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", 
+        return db.execute("INSERT INTO Alumnos (curso_id, nombre, dni, observaciones, tutor_nombre, tutor_telefono, tpp, tpp_dias) VALUES (%s, %s, %s, %s, %s, %s, %s, %s); NOTIFY cache_invalidate, 'alumnos'", 
                           (data['curso_id'], data['nombre'], data['dni'], data['obs'], data['tn'], data['tt'], data['tpp'], data['tpp_dias']))
     
     @staticmethod
     def update_alumno(aid, data):
-        return db.execute("UPDATE Alumnos SET nombre=%s, dni=%s, observaciones=%s, tutor_nombre=%s, tutor_telefono=%s, tpp=%s, tpp_dias=%s WHERE id=%s", 
+        return db.execute("UPDATE Alumnos SET nombre=%s, dni=%s, observaciones=%s, tutor_nombre=%s, tutor_telefono=%s, tpp=%s, tpp_dias=%s WHERE id=%s; NOTIFY cache_invalidate, 'alumnos'", 
                           (data['nombre'], data['dni'], data['obs'], data['tn'], data['tt'], data['tpp'], data['tpp_dias'], aid))
 
+# Los cambios hechos por otros procesos llegan por NOTIFY y vacían la caché local al instante.
+# Cualquier aviso (también 'alumnos', 'asistencia' y 'legajo') sube data_version y con eso
+# invalida las vistas cacheadas; estos temas solo necesitan callback si tienen caché propia.
+db.subscribe('ciclo', SchoolService.invalidate_ciclo)
+db.subscribe('cursos', SchoolService.invalidate_cursos)
+
 class DocService:
     @staticmethod
     def get_requisitos_curso(curso_id):
@@ -294,74 +704,169 @@ class DocService:
     
     @staticmethod
     def add_requisito(curso_id, desc):
-        return db.execute("INSERT INTO Requisitos (curso_id, descripcion) VALUES (%s, %s)", (curso_id, desc))
+        return db.execute("INSERT INTO Requisitos (curso_id, descripcion) VALUES (%s, %s); NOTIFY cache_invalidate, 'legajo'", (curso_id, desc))
     
     @staticmethod
     def delete_requisito(rid):
-        return db.execute("DELETE FROM Requisitos WHERE id = %s", (rid,))
+        return db.execute("DELETE FROM Requisitos WHERE id = %s; NOTIFY cache_invalidate, 'legajo'", (rid,))
     
     @staticmethod
-    def get_estado_alumno(aid):
-        rows = db.fetch_all("SELECT requisito_id, entregado FROM Documentacion_Alumno WHERE alumno_id = %s", (aid,))
-        return {r['requisito_id']: r['entregado'] for r in rows}
-    
+    def get_legajo_alumno(aid, curso_id):
+        # Requisitos del curso con el estado de entrega del alumno, en una sola consulta
+        return db.fetch_all("""
+            SELECT r.id, r.descripcion, COALESCE(d.entregado, 0) AS entregado
+            FROM Requisitos r
+            LEFT JOIN Documentacion_Alumno d ON d.requisito_id = r.id AND d.alumno_id = %s
+            WHERE r.curso_id = %s ORDER BY r.descripcion
+        """, (aid, curso_id))
+
     @staticmethod
     def toggle_entrega(aid, rid, estado):
         val = 1 if estado else 0
-        q = "INSERT INTO Documentacion_Alumno (requisito_id, alumno_id, entregado) VALUES (%s, %s, %s) ON CONFLICT (requisito_id, alumno_id) DO UPDATE SET entregado=EXCLUDED.entregado"
+        q = "INSERT INTO Documentacion_Alumno (requisito_id, alumno_id, entregado) VALUES (%s, %s, %s) ON CONFLICT (requisito_id, alumno_id) DO UPDATE SET entregado=EXCLUDED.entregado; NOTIFY cache_invalidate, 'legajo'"
         db.execute(q, (rid, aid, val))
 
 class AttendanceService:
-    @staticmethod
-    def get_day_status(curso_id, fecha):
-        rows = db.fetch_all("SELECT alumno_id, status FROM Asistencia WHERE fecha = %s AND alumno_id IN (SELECT id FROM Alumnos WHERE curso_id=%s)", (fecha, curso_id))
-        return {row['alumno_id']: row['status'] for row in rows}
+    # --- Marcas diferidas: los cambios de los dropdowns se agrupan y se escriben en lote ---
+    _FLUSH_DELAY = 0.5
+    _RETRY_DELAY = 5
+    _pending = {}
+    _pending_lock = threading.Lock()
+    _flush_lock = threading.Lock()  # serializa escrituras para respetar el orden de las marcas
+    _wake = threading.Event()
 
     @staticmethod
     def mark(aid, fecha, status):
-        q = "INSERT INTO Asistencia (alumno_id, fecha, status) VALUES (%s, %s, %s) ON CONFLICT (alumno_id, fecha) DO UPDATE SET status = EXCLUDED.status"
-        return db.execute(q, (aid, fecha, status))
+        # Encola la marca y vuelve enseguida; el hilo escritor la persiste en lote (o flush())
+        with AttendanceService._pending_lock:
+            AttendanceService._pending[(aid, fecha)] = status
+        AttendanceService._wake.set()
 
     @staticmethod
-    def get_stats(aid):
-        rows = db.fetch_all("SELECT status FROM Asistencia WHERE alumno_id = %s", (aid,))
-        return AttendanceService._calc_stats(rows)
+    def start_writer():
+        threading.Thread(target=AttendanceService._writer_loop, daemon=True, name="asistencia-writer").start()
+
+    @staticmethod
+    def _writer_loop():
+        # Un único hilo escritor en lugar de un Timer (un hilo nuevo) por cada cambio de dropdown
+        while True:
+            AttendanceService._wake.wait()
+            time.sleep(AttendanceService._FLUSH_DELAY)  # ventana para agrupar las marcas siguientes
+            AttendanceService._wake.clear()
+            if not AttendanceService.flush():
+                time.sleep(AttendanceService._RETRY_DELAY)
+                AttendanceService._wake.set()
+
+    @staticmethod
+    def flush():
+        with AttendanceService._flush_lock:
+            with AttendanceService._pending_lock:
+                pending = AttendanceService._pending
+                AttendanceService._pending = {}
+            quedan = AttendanceService._write_or_split([(aid, fecha, st) for (aid, fecha), st in pending.items()])
+            if quedan:
+                # Se reencolan para el próximo flush, sin pisar marcas más nuevas
+                with AttendanceService._pending_lock:
+                    for aid, fecha, st in quedan: AttendanceService._pending.setdefault((aid, fecha), st)
+            return not quedan
+
+    @staticmethod
+    def _write_or_split(rows):
+        # Devuelve las filas que siguen pendientes (falla transitoria: DB caída, pool agotado).
+        # Si el lote falla por una fila inválida (p. ej. alumno borrado), se parte en mitades hasta
+        # aislarla; esa fila se descarta para que no bloquee las marcas de los demás.
+        try:
+            return [] if AttendanceService.mark_bulk(rows, strict=True) else rows
+        except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+            if len(rows) == 1:
+                print(f"❌ Marca descartada {rows[0]}: {e}")
+                return []
+            mid = len(rows) // 2
+            return AttendanceService._write_or_split(rows[:mid]) + AttendanceService._write_or_split(rows[mid:])
+        except psycopg2.Error:
+            return rows
+
+    @staticmethod
+    def mark_bulk(rows, strict=False):
+        # rows: lista de (alumno_id, fecha, status)
+        if not rows: return True
+        q = "INSERT INTO Asistencia (alumno_id, fecha, status) VALUES %s ON CONFLICT (alumno_id, fecha) DO UPDATE SET status = EXCLUDED.status"
+        return db.execute_values(q, rows, strict=strict, notify='asistencia')
+
+    # Conteo por estado resuelto en Postgres: una fila en lugar de todo el historial
+    # Columnas en orden (P, T, A, J, S): se leen por posición
+    _COUNTS_SQL = """SELECT COUNT(*) FILTER (WHERE status = 'P'), COUNT(*) FILTER (WHERE status = 'T'),
+                            COUNT(*) FILTER (WHERE status = 'A'), COUNT(*) FILTER (WHERE status = 'J'),
+                            COUNT(*) FILTER (WHERE status = 'S')
+                     FROM Asistencia WHERE alumno_id = %s"""
 
     @staticmethod
     def get_stats_range(aid, f_inicio, f_fin):
-        rows = db.fetch_all("SELECT status FROM Asistencia WHERE alumno_id = %s AND fecha >= %s AND fecha <= %s", (aid, f_inicio, f_fin))
-        return AttendanceService._calc_stats(rows)
+        rows = db.fetch_rows(AttendanceService._COUNTS_SQL + " AND fecha >= %s AND fecha <= %s", (aid, f_inicio, f_fin))
+        return AttendanceService._stats_from_counts(*(rows[0] if rows else (0, 0, 0, 0, 0)))
     
     @staticmethod
-    def _calc_stats(rows):
-        c = {k: 0 for k in ['P','T','A','J','S','N']}
-        for r in rows:
-            if r['status'] in c: c[r['status']] += 1
-        
-        faltas = c['A'] + c['S'] + (c['T'] * 0.5) 
-        total = sum(c[k] for k in ['P','T','A','J','S'])
+    def get_report_matrix(curso_id, f_inicio, f_fin):
+        # Una sola consulta: alumnos del curso + conteos por estado en el período.
+        # Se consume en streaming (generador): el reporte escribe cada fila a medida que llega.
+        rows = db.stream_rows("""
+            SELECT a.id, a.nombre, a.dni,
+                   COUNT(s.status) FILTER (WHERE s.status = 'P'),
+                   COUNT(s.status) FILTER (WHERE s.status = 'T'),
+                   COUNT(s.status) FILTER (WHERE s.status = 'A'),
+                   COUNT(s.status) FILTER (WHERE s.status = 'J'),
+                   COUNT(s.status) FILTER (WHERE s.status = 'S')
+            FROM Alumnos a
+            LEFT JOIN Asistencia s ON s.alumno_id = a.id AND s.fecha >= %s AND s.fecha <= %s
+            WHERE a.curso_id = %s
+            GROUP BY a.id
+            ORDER BY a.nombre
+        """, (f_inicio, f_fin, curso_id))
+        return ({'id': aid, 'nombre': nombre, 'dni': dni, 'stats': AttendanceService._stats_from_counts(p, t, a, j, s)}
+                for aid, nombre, dni, p, t, a, j, s in rows)
+    
+    @staticmethod
+    def _stats_from_counts(p, t, a, j, s):
+        faltas = a + s + (t * 0.5) 
+        total = p + t + a + j + s
         pct = (1 - (faltas / total)) * 100 if total > 0 else 100
         
         return {
-            'p': c['P'], 'a': c['A'], 't': c['T'], 'j': c['J'], 's': c['S'],
+            'p': p, 'a': a, 't': t, 'j': j, 's': s,
             'faltas': faltas, 'pct': round(pct, 1), 'total': total
         }
 
-    @staticmethod
-    def get_history(aid):
-        return db.fetch_all("SELECT fecha, status FROM Asistencia WHERE alumno_id = %s ORDER BY fecha DESC", (aid,))
-
     @staticmethod
     def get_history_range(aid, f_inicio, f_fin):
         return db.fetch_all("SELECT fecha, status FROM Asistencia WHERE alumno_id = %s AND fecha >= %s AND fecha <= %s ORDER BY fecha ASC", (aid, f_inicio, f_fin))
 
+AttendanceService.start_writer()
+atexit.register(AttendanceService.flush)  # corre antes que db.close (atexit es LIFO)
+# atexit no corre si el proceso muere por SIGTERM (p. ej. al reiniciar el servicio):
+# se convierte en una salida normal para que las marcas encoladas lleguen a la DB
+def _sigterm_exit(signum, frame): sys.exit(0)
+
+# Los reportes se generan fuera del hilo del evento para no congelar la UI
+EXPORT_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="export")
+
 class ReportService:
+    # Filas volcadas a disco a medida que se escriben (se escriben siempre en orden)
+    WORKBOOK_OPTIONS = {'constant_memory': True}
+    STATUS_LABELS = {'P': 'Presente', 'A': 'Ausente', 'T': 'Tarde', 'S': 'Suspendido', 'J': 'Justificado', 'N': 'No Corresp.'}
+
+    @staticmethod
+    def submit(fn, *args, on_done=None):
+        future = EXPORT_POOL.submit(fn, *args)
+        if on_done: future.add_done_callback(on_done)
+        return future
+
     @staticmethod
     def generate_excel_curso(curso_id, f_inicio, f_fin):
+        xlsxwriter = load_xlsxwriter()
         if not xlsxwriter: return None
         try:
             output = io.BytesIO()
-            workbook = xlsxwriter.Workbook(output)
+            workbook = xlsxwriter.Workbook(output, ReportService.WORKBOOK_OPTIONS)
             ws = workbook.add_worksheet("Curso")
             
             title_fmt = workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center'})
@@ -375,9 +880,8 @@ class ReportService:
             ws.write_row(2, 0, headers, header_fmt)
             ws.set_column(0, 0, 30) 
             
-            alumnos = SchoolService.get_alumnos(curso_id)
-            for i, a in enumerate(alumnos, start=3):
-                stats = AttendanceService.get_stats_range(a['id'], f_inicio, f_fin)
+            for i, a in enumerate(AttendanceService.get_report_matrix(curso_id, f_inicio, f_fin), start=3):
+                stats = a['stats']
                 
                 ws.write(i, 0, a['nombre'], cell_fmt)
                 ws.write(i, 1, a['dni'] or "-", cell_fmt)
@@ -395,6 +899,7 @@ class ReportService:
 
     @staticmethod
     def generate_excel_alumno(alumno_id, f_inicio, f_fin):
+        xlsxwriter = load_xlsxwriter()
         if not xlsxwriter: return None
         try:
             alumno = SchoolService.get_alumno(alumno_id)
@@ -402,7 +907,7 @@ class ReportService:
             stats = AttendanceService.get_stats_range(alumno_id, f_inicio, f_fin)
             
             output = io.BytesIO()
-            workbook = xlsxwriter.Workbook(output)
+            workbook = xlsxwriter.Workbook(output, ReportService.WORKBOOK_OPTIONS)
             ws = workbook.add_worksheet("Alumno")
             
             bold = workbook.add_format({'bold': True})
@@ -425,8 +930,7 @@ class ReportService:
             
             for i, h in enumerate(historial, start=11):
                 ws.write(i, 0, h['fecha'], cell)
-                mapa = {'P': 'Presente', 'A': 'Ausente', 'T': 'Tarde', 'S': 'Suspendido', 'J': 'Justificado', 'N': 'No Corresp.'}
-                ws.write(i, 1, mapa.get(h['status'], h['status']), cell)
+                ws.write(i, 1, ReportService.STATUS_LABELS.get(h['status'], h['status']), cell)
                 
             workbook.close()
             output.seek(0)
@@ -442,14 +946,21 @@ def view_login(page: ft.Page):
     pass_tf = ft.TextField(label="Contraseña", password=True, width=300, bgcolor="white", border_radius=8, prefix_icon="lock", can_reveal_password=True)
 
     def login(e):
-        user = UserService.login(user_tf.value, pass_tf.value)
+        # PBKDF2 tarda: se bloquea el botón mientras se verifica (evita reintentos y dobles clics)
+        btn_login.disabled = True; btn_login.text = "VERIFICANDO..."; page.update()
+        try:
+            user = UserService.login(user_tf.value, pass_tf.value)
+        finally:
+            btn_login.disabled = False; btn_login.text = "INGRESAR"
         if user:
-            page.session.set("user", user)
+            UIHelper.set_user(page, user)
             page.route = "/dashboard"
             page.update()
         else:
             UIHelper.show_snack(page, "Credenciales incorrectas", True)
 
+    btn_login = ft.ElevatedButton("INGRESAR", on_click=login, width=300, height=50, bgcolor=THEME["primary"], color="white")
+
     return ft.View("/", [
         ft.Container(
             content=ft.Column([
@@ -457,7 +968,7 @@ def view_login(page: ft.Page):
                 ft.Text("Asistencia UNSAM", size=28, weight="bold", color=THEME["secondary"]),
                 UIHelper.create_card(ft.Column([
                     user_tf, ft.Container(height=10), pass_tf, ft.Container(height=20),
-                    ft.ElevatedButton("INGRESAR", on_click=login, width=300, height=50, bgcolor=THEME["primary"], color="white")
+                    btn_login
                 ], horizontal_alignment="center"), padding=40),
             ], horizontal_alignment="center"),
             alignment=ft.alignment.center, expand=True, bgcolor=THEME["bg"]
@@ -465,20 +976,35 @@ def view_login(page: ft.Page):
     ])
 
 def view_dashboard(page: ft.Page):
-    user = page.session.get("user")
+    user = UIHelper.current_user(page)
     if not user: return view_login(page)
     
     txt_ciclo = ft.Text("Cargando...", weight="bold", color="white")
     grid = ft.GridView(runs_count=2, max_extent=400, child_aspect_ratio=2.5, spacing=15, run_spacing=15)
     
+    cards = {}
+
+    def build_card(c):
+        def go(e, cid=c['id'], cn=c['nombre']):
+            page.session.set("curso_id", cid); page.session.set("curso_nombre", cn); page.route = "/curso"; page.update()
+        
+        return UIHelper.create_card(
+            ft.Row([
+                ft.Row([
+                    ft.Container(content=ft.Icon("class_", color="white"), bgcolor=THEME["primary"], border_radius=10, padding=12),
+                    ft.Text(c['nombre'], size=18, weight="bold", color=THEME["text"])
+                ]),
+                ft.IconButton("arrow_forward_ios", icon_color=THEME["primary"], on_click=go)
+            ], alignment="spaceBetween"), padding=15, on_click=go
+        )
+
     def load():
         ciclo = SchoolService.get_ciclo_activo()
-        grid.controls.clear()
         
         if not ciclo:
             txt_ciclo.value = "⚠️ SIN CICLO ACTIVO"
             txt_ciclo.color = "#FFCDD2"
-            grid.controls.append(ft.Text("No hay ciclo lectivo activo.", italic=True, color="red"))
+            cards.clear(); grid.controls[:] = [ft.Text("No hay ciclo lectivo activo.", italic=True, color="red")]
         else:
             txt_ciclo.value = f"Ciclo: {ciclo['nombre']}"
             txt_ciclo.color = "white"
@@ -486,25 +1012,13 @@ def view_dashboard(page: ft.Page):
             
             if not cursos:
                 msg = "No tenés cursos asignados." if user['role'] != 'admin' else "No hay cursos."
-                grid.controls.append(ft.Text(msg, italic=True, color="grey"))
-
-            for c in cursos:
-                def go(e, cid=c['id'], cn=c['nombre']):
-                    page.session.set("curso_id", cid); page.session.set("curso_nombre", cn); page.route = "/curso"; page.update()
-                
-                grid.controls.append(UIHelper.create_card(
-                    ft.Row([
-                        ft.Row([
-                            ft.Container(content=ft.Icon("class_", color="white"), bgcolor=THEME["primary"], border_radius=10, padding=12),
-                            ft.Text(c['nombre'], size=18, weight="bold", color=THEME["text"])
-                        ]),
-                        ft.IconButton("arrow_forward_ios", icon_color=THEME["primary"], on_click=go)
-                    ], alignment="spaceBetween"), padding=15, on_click=go
-                ))
+                cards.clear(); grid.controls[:] = [ft.Text(msg, italic=True, color="grey")]
+            else:
+                UIHelper.sync_controls(grid.controls, cards, cursos, lambda c: (c['id'], c['nombre']), build_card)
 
     load()
 
-    actions = [ft.IconButton("logout", icon_color="white", on_click=lambda _: page.go("/"))]
+    actions = [ft.IconButton("logout", icon_color="white", on_click=lambda _: (UIHelper.set_user(page, None), page.go("/")))]
     if user['role'] == 'admin': 
         actions.insert(0, ft.IconButton("settings", icon_color="white", on_click=lambda _: page.go("/admin")))
 
@@ -541,13 +1055,17 @@ def view_curso(page: ft.Page):
     if not cid: return view_dashboard(page)
     
     # --- EXPORTADOR DIRECTO ---
-    def download_excel(e):
+    def download_excel(e, dlg):
         start = export_range["start"]
         end = export_range["end"]
+        UIHelper.show_snack(page, "⏳ Generando reporte...")
+        ReportService.submit(ReportService.generate_excel_curso, cid, start, end, on_done=lambda f: deliver_excel(f, start, end, dlg))
+
+    def deliver_excel(future, start, end, dlg):
         try:
-            excel_data = ReportService.generate_excel_curso(cid, start, end)
+            excel_data = future.result()
             if excel_data:
-                b64_data = base64.b64encode(excel_data.getvalue()).decode()
+                b64_data = base64.b64encode(excel_data.getbuffer()).decode()
                 filename = f"Reporte_{cn}_{start}_{end}.xlsx"
                 page.launch_url(f"data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64_data}")
                 page.close(dlg)
@@ -568,7 +1086,7 @@ def view_curso(page: ft.Page):
         def confirm_click(e):
             export_range["start"] = tf_start.value
             export_range["end"] = tf_end.value
-            download_excel(e)
+            download_excel(e, dlg)
 
         dlg = ft.AlertDialog(
             title=ft.Text("Exportar Asistencia"),
@@ -628,75 +1146,100 @@ def view_curso(page: ft.Page):
         page.open(dlg_reqs)
 
     # --- UI Principal ---
-    lv = ft.Column(scroll="auto", expand=True)
+    # ListView: solo se materializan las filas visibles (cursos con muchos alumnos)
+    lv = ft.ListView(expand=True, spacing=10)
+    alumno_rows = {}
+    day_cache = {"key": None, "data": []}
+
+    def get_alumnos_dia():
+        # Alumnos + estado del día elegido, compartido por ambas pestañas.
+        # Se relee solo si cambia la fecha o hubo alguna escritura (data_version).
+        key = (date_tf.value, db.data_version)
+        if day_cache["key"] != key:
+            day_cache["data"] = SchoolService.get_alumnos_with_status(cid, date_tf.value)
+            day_cache["key"] = key
+        return day_cache["data"]
+
+    def build_alumno_row(a):
+        def det(e, aid=a['id']): page.session.set("alumno_id", aid); page.go("/student_detail")
+        def edt(e, aid=a['id']): page.session.set("alumno_id_edit", aid); page.go("/form_student")
+        sub = f"DNI: {a['dni'] or '-'}"
+        if a['tpp'] == 1: sub += " | ⚠️ TPP"
+        return UIHelper.create_card(ft.ListTile(
+            leading=ft.CircleAvatar(content=ft.Text(a['nombre'][0]), bgcolor=THEME["secondary"], color="white"),
+            title=ft.Text(a['nombre'], weight="bold"),
+            subtitle=ft.Text(sub),
+            on_click=det,
+            trailing=ft.IconButton("edit", on_click=edt)
+        ), padding=0)
+
     def load_alumnos():
-        lv.controls.clear()
-        for a in SchoolService.get_alumnos(cid):
-            def det(e, aid=a['id']): page.session.set("alumno_id", aid); page.go("/student_detail")
-            def edt(e, aid=a['id']): page.session.set("alumno_id_edit", aid); page.go("/form_student")
-            sub = f"DNI: {a['dni'] or '-'}"
-            if a['tpp'] == 1: sub += " | ⚠️ TPP"
-            lv.controls.append(UIHelper.create_card(ft.ListTile(
-                leading=ft.CircleAvatar(content=ft.Text(a['nombre'][0]), bgcolor=THEME["secondary"], color="white"),
-                title=ft.Text(a['nombre'], weight="bold"),
-                subtitle=ft.Text(sub),
-                on_click=det,
-                trailing=ft.IconButton("edit", on_click=edt)
-            ), padding=0))
-        page.update()
+        # La clave cubre los campos visibles: una edición del alumno invalida solo su fila
+        if UIHelper.sync_controls(lv.controls, alumno_rows, get_alumnos_dia(), lambda a: (a['id'], a['nombre'], a['dni'], a['tpp']), build_alumno_row):
+            page.update()
 
     date_tf = ft.TextField(label="Fecha", value=date.today().isoformat(), width=150, height=40, text_size=14)
-    asist_col = ft.Column(scroll="auto", expand=True)
+    asist_col = ft.ListView(expand=True, spacing=10)
     
+    def mark_dispatch(e):
+        # Un único handler para todos los selectores; el id del alumno viaja en control.data
+        AttendanceService.mark(e.control.data, date_tf.value, e.control.value)
+
+    asist_rows = {}
+
+    def build_asist_row(a):
+        dd = ft.Dropdown(
+            width=100, height=40, text_size=14, data=a['id'],
+            options=[ft.dropdown.Option(x) for x in STATUS_CODES], 
+            on_change=mark_dispatch
+        )
+        # La fila guarda su dropdown en .data para poder actualizar solo el valor
+        return ft.Container(content=ft.Row([ft.Text(a['nombre'], expand=True, weight="w500"), dd]), padding=5, border=ft.border.only(bottom=ft.border.BorderSide(1, "grey200")), data=dd)
+
     def load_asist(e=None):
-        asist_col.controls.clear()
+        # flush() antes de tomar conexión: el escritor pide una del pool teniendo el lock de flush
+        AttendanceService.flush()  # lo que se muestra debe reflejar las marcas pendientes
         try:
-            d_obj = date.fromisoformat(date_tf.value)
-            dia_sem = d_obj.weekday()
+            _, dia_sem = parse_date(date_tf.value)
             if dia_sem >= 5: UIHelper.show_snack(page, "Aviso: Fin de semana", False)
-        except: dia_sem = -1
-
-        status_map = AttendanceService.get_day_status(cid, date_tf.value)
-        for a in SchoolService.get_alumnos(cid):
-            def_val = "P"
-            if a['tpp'] == 1 and a['tpp_dias']:
-                if str(dia_sem) not in a['tpp_dias'].split(','): def_val = "N"
-            
-            val = status_map.get(a['id'], def_val)
-            dd = ft.Dropdown(
-                width=100, height=40, text_size=14, value=val,
-                options=[ft.dropdown.Option(x) for x in ["P","T","A","J","S","N"]], 
-                on_change=lambda e, aid=a['id']: AttendanceService.mark(aid, date_tf.value, e.control.value)
-            )
-            asist_col.controls.append(ft.Container(content=ft.Row([ft.Text(a['nombre'], expand=True, weight="w500"), dd]), padding=5, border=ft.border.only(bottom=ft.border.BorderSide(1, "grey200"))))
-        page.update()
+        except: dia_sem = 7
+
+        # Al cambiar de día se reutilizan las filas; solo cambian los valores de los dropdowns
+        with db.request_scope():
+            alumnos = get_alumnos_dia()
+        changed = UIHelper.sync_controls(asist_col.controls, asist_rows, alumnos, lambda a: (a['id'], a['nombre']), build_asist_row)
+        for row, a in zip(asist_col.controls, alumnos):
+            val = a['status'] or ("P" if (a['tpp_mask'] >> dia_sem) & 1 else "N")
+            if row.data.value != val: row.data.value = val; changed = True
+        if changed: page.update()  # "refrescar" sin cambios no re-envía el árbol
     
     # --- FIX: GUARDADO INTELIGENTE DE "NO TOCADOS" ---
     def guardar_asistencia_manual(e):
+        # Si quedan marcas manuales sin guardar, no se completan los automáticos encima de ellas.
+        # Igual que en load_asist, flush() va fuera de cualquier request_scope.
+        if not AttendanceService.flush():
+            return UIHelper.show_snack(page, "Error al guardar la asistencia", True)
         fecha = date_tf.value
-        alumnos = SchoolService.get_alumnos(cid)
-        # Obtenemos qué hay guardado en la DB ahora mismo
-        status_map = AttendanceService.get_day_status(cid, fecha)
+        # Alumnos + lo que hay guardado en la DB ahora mismo, en una sola consulta
+        alumnos = SchoolService.get_alumnos_with_status(cid, fecha)
         
         try:
-            d_obj = date.fromisoformat(fecha)
-            dia_sem = d_obj.weekday()
-        except: dia_sem = -1
+            _, dia_sem = parse_date(fecha)
+        except: dia_sem = 7
 
-        count_fixed = 0
+        pendientes = []
         for a in alumnos:
             # Si el alumno NO está en la DB, es porque quedó con el valor por defecto en pantalla
             # pero no se disparó el evento de guardado. Lo guardamos ahora.
-            if a['id'] not in status_map:
-                def_val = "P" # Por defecto es Presente
-                if a['tpp'] == 1 and a['tpp_dias']:
-                    if str(dia_sem) not in a['tpp_dias'].split(','): 
-                        def_val = "N" # Salvo que sea TPP y no le toque venir
-                
-                AttendanceService.mark(a['id'], fecha, def_val)
-                count_fixed += 1
+            if a['status'] is None:
+                # Por defecto es Presente, salvo que sea TPP y no le toque venir
+                def_val = "P" if (a['tpp_mask'] >> dia_sem) & 1 else "N"
+                pendientes.append((a['id'], fecha, def_val))
         
-        UIHelper.show_snack(page, f"✅ Asistencia completada ({count_fixed} automáticos).")
+        # Un solo INSERT para todos los automáticos
+        if not AttendanceService.mark_bulk(pendientes):
+            return UIHelper.show_snack(page, "Error al guardar la asistencia", True)
+        UIHelper.show_snack(page, f"✅ Asistencia completada ({len(pendientes)} automáticos).")
         page.go("/dashboard")
 
     tabs = ft.Tabs(selected_index=0, tabs=[
@@ -724,6 +1267,7 @@ def view_curso(page: ft.Page):
     ) if tabs.selected_index == 1 else ft.FloatingActionButton(icon="person_add", bgcolor=THEME["primary"], on_click=lambda _: (page.session.set("alumno_id_edit", None), page.go("/form_student")))
 
     def on_tab_change(e):
+        AttendanceService.flush()
         if e.control.selected_index == 1: 
             page.views[-1].floating_action_button = ft.FloatingActionButton(
                 icon="save", text="GUARDAR ASISTENCIA", bgcolor="green", on_click=guardar_asistencia_manual, width=220
@@ -748,7 +1292,7 @@ def view_form_student(page: ft.Page):
     nm = ft.TextField(label="Nombre"); dn = ft.TextField(label="DNI"); tn = ft.TextField(label="Tutor"); tt = ft.TextField(label="Tel. Tutor"); ob = ft.TextField(label="Observaciones", multiline=True)
     
     sw_tpp = ft.Switch(label="Activar Trayectoria (TPP)", value=False)
-    checks = [ft.Checkbox(label=d, value=True, data=str(i)) for i, d in enumerate(["Lun","Mar","Mié","Jue","Vie"])]
+    checks = [ft.Checkbox(label=d, value=True, data=str(i)) for i, d in enumerate(DIAS_SEMANA)]
     cont_days = ft.Column([ft.Text("Días Asistencia:")] + checks, visible=False)
     sw_tpp.on_change = lambda e: (setattr(cont_days, 'visible', sw_tpp.value), page.update())
 
@@ -782,22 +1326,23 @@ def view_form_student(page: ft.Page):
 def view_student_detail(page: ft.Page):
     aid = page.session.get("alumno_id")
     if not aid: return view_dashboard(page)
-    alumno = SchoolService.get_alumno(aid)
+    alumno, stats, history = SchoolService.get_student_bundle(aid)
     if not alumno: return view_dashboard(page)
     
-    stats = AttendanceService.get_stats(aid)
-    history = AttendanceService.get_history(aid)
-    
     # --- EXPORTAR INDIVIDUAL (FIX DIRECTO) ---
     export_range_ind = {"start": "", "end": ""}
 
-    def download_individual(e):
+    def download_individual(e, dlg):
         start = export_range_ind["start"]
         end = export_range_ind["end"]
+        UIHelper.show_snack(page, "⏳ Generando informe...")
+        ReportService.submit(ReportService.generate_excel_alumno, aid, start, end, on_done=lambda f: deliver_individual(f, dlg))
+
+    def deliver_individual(future, dlg):
         try:
-            excel_data = ReportService.generate_excel_alumno(aid, start, end)
+            excel_data = future.result()
             if excel_data:
-                b64_data = base64.b64encode(excel_data.getvalue()).decode()
+                b64_data = base64.b64encode(excel_data.getbuffer()).decode()
                 page.launch_url(f"data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64_data}")
                 page.close(dlg)
                 UIHelper.show_snack(page, "📥 Informe individual descargado.")
@@ -815,7 +1360,7 @@ def view_student_detail(page: ft.Page):
         def confirm(e):
             export_range_ind["start"] = tf_start.value
             export_range_ind["end"] = tf_end.value
-            download_individual(e)
+            download_individual(e, dlg)
             
         dlg = ft.AlertDialog(
             title=ft.Text("Exportar Historial"),
@@ -858,18 +1403,19 @@ def view_student_detail(page: ft.Page):
 
     # --- BLOQUE 3: DOCS ---
     docs_col = ft.Column()
-    reqs = DocService.get_requisitos_curso(alumno['curso_id'])
-    estados = DocService.get_estado_alumno(aid)
+    reqs = DocService.get_legajo_alumno(aid, alumno['curso_id'])
     
     if not reqs: docs_col.controls.append(ft.Text("No hay requisitos.", italic=True))
     for r in reqs:
-        is_checked = estados.get(r['id']) == 1
+        is_checked = r['entregado'] == 1
         docs_col.controls.append(ft.Checkbox(label=r['descripcion'], value=is_checked, on_change=lambda e, rid=r['id']: (DocService.toggle_entrega(aid, rid, e.control.value), UIHelper.show_snack(page, "Actualizado"))))
     
     card_docs = UIHelper.create_card(ft.Column([ft.Text("Legajo / Documentación", weight="bold"), ft.Divider(), docs_col]))
 
     # --- BLOQUE 4: HISTORIAL ---
-    hist_col = ft.Column([ft.Text(f"{h['fecha']}: {h['status']}", size=14) for h in history], scroll="auto", height=200)
+    # Un solo Text con todo el historial: un control en lugar de uno por fila
+    hist_text = "\n".join(f"{h['fecha']}: {h['status']}" for h in history)
+    hist_col = ft.Column([ft.Text(hist_text, size=14, selectable=True)], scroll="auto", height=200)
     card_hist = UIHelper.create_card(ft.Column([
         ft.Row([ft.Text("Historial Completo", weight="bold"), ft.IconButton("file_download", icon_color="green", tooltip="Exportar Excel", on_click=open_export_ind)], alignment="spaceBetween"),
         ft.Divider(),
@@ -894,24 +1440,28 @@ def view_admin(page: ft.Page):
 
 def view_ciclos(page: ft.Page):
     tf = ft.TextField(label="Año (Ej: 2026)", expand=True)
-    col = ft.Column(scroll="auto")
+    col = ft.ListView(expand=True, spacing=10)
     
+    cards = {}
+
+    def build_card(c):
+        is_active = c['activo'] == 1
+        if is_active:
+            act_btn = ft.Container(content=ft.Text("ACTIVO", color="white", size=10, weight="bold"), bgcolor="green", padding=5, border_radius=5)
+        else:
+            act_btn = ft.ElevatedButton("Activar", on_click=lambda e, cid=c['id']: (SchoolService.activar_ciclo(cid), load(), page.update()))
+        
+        del_btn = ft.IconButton("delete", icon_color="red", on_click=lambda e, cid=c['id']: (SchoolService.delete_ciclo(cid), load(), page.update()))
+        
+        return UIHelper.create_card(ft.ListTile(
+            leading=ft.Icon("check_circle" if is_active else "circle_outlined", color="green" if is_active else "grey"),
+            title=ft.Text(c['nombre'], weight="bold"),
+            trailing=ft.Row([act_btn, del_btn], tight=True)
+        ), padding=5)
+
     def load():
-        col.controls.clear()
-        for c in SchoolService.get_ciclos():
-            is_active = c['activo'] == 1
-            if is_active:
-                act_btn = ft.Container(content=ft.Text("ACTIVO", color="white", size=10, weight="bold"), bgcolor="green", padding=5, border_radius=5)
-            else:
-                act_btn = ft.ElevatedButton("Activar", on_click=lambda e, cid=c['id']: (SchoolService.activar_ciclo(cid), load(), page.update()))
-            
-            del_btn = ft.IconButton("delete", icon_color="red", on_click=lambda e, cid=c['id']: (SchoolService.delete_ciclo(cid), load(), page.update()))
-            
-            col.controls.append(UIHelper.create_card(ft.ListTile(
-                leading=ft.Icon("check_circle" if is_active else "circle_outlined", color="green" if is_active else "grey"),
-                title=ft.Text(c['nombre'], weight="bold"),
-                trailing=ft.Row([act_btn, del_btn], tight=True)
-            ), padding=5))
+        # La clave incluye 'activo' para que al cambiar el ciclo activo se reconstruyan solo esas dos tarjetas
+        UIHelper.sync_controls(col.controls, cards, SchoolService.get_ciclos(), lambda c: (c['id'], c['nombre'], c['activo']), build_card)
     
     def add(e):
         if tf.value:
@@ -929,7 +1479,8 @@ def view_ciclos(page: ft.Page):
 
 def view_users(page: ft.Page):
     u = ft.TextField(label="Usuario"); p = ft.TextField(label="Clave", password=True); r = ft.Dropdown(value="preceptor", options=[ft.dropdown.Option("admin"), ft.dropdown.Option("preceptor")])
-    col = ft.Column(scroll="auto")
+    col = ft.ListView(expand=True, spacing=10)
+    me = UIHelper.current_user(page)['username']
     
     def open_assign_dlg(uid, username):
         cursos = SchoolService.get_cursos_all_active()
@@ -942,15 +1493,18 @@ def view_users(page: ft.Page):
         dlg = ft.AlertDialog(title=ft.Text(f"Cursos para {username}"), content=checks_col)
         page.open(dlg)
 
+    cards = {}
+
+    def build_card(us):
+        actions = []
+        if us['role'] != 'admin':
+            actions.append(ft.IconButton("assignment_ind", icon_color="blue", tooltip="Asignar Cursos", on_click=lambda e, uid=us['id'], un=us['username']: open_assign_dlg(uid, un)))
+        if us['username'] != me:
+            actions.append(ft.IconButton("delete", icon_color="red", tooltip="Eliminar", on_click=lambda e, uid=us['id']: (UserService.delete_user(uid), load(), page.update())))
+        return UIHelper.create_card(ft.ListTile(leading=ft.Icon("person"), title=ft.Text(us['username']), subtitle=ft.Text(us['role']), trailing=ft.Row(actions, tight=True)), padding=5)
+
     def load():
-        col.controls.clear()
-        for us in UserService.get_users():
-            actions = []
-            if us['role'] != 'admin':
-                actions.append(ft.IconButton("assignment_ind", icon_color="blue", tooltip="Asignar Cursos", on_click=lambda e, uid=us['id'], un=us['username']: open_assign_dlg(uid, un)))
-            if us['username'] != page.session.get("user")['username']:
-                actions.append(ft.IconButton("delete", icon_color="red", tooltip="Eliminar", on_click=lambda e, uid=us['id']: (UserService.delete_user(uid), load(), page.update())))
-            col.controls.append(UIHelper.create_card(ft.ListTile(leading=ft.Icon("person"), title=ft.Text(us['username']), subtitle=ft.Text(us['role']), trailing=ft.Row(actions, tight=True)), padding=5))
+        UIHelper.sync_controls(col.controls, cards, UserService.get_users(), lambda us: (us['id'], us['username'], us['role']), build_card)
 
     def add(e):
         if u.value and p.value: UserService.add_user(u.value, p.value, r.value); u.value = ""; p.value = ""; load(); page.update()
@@ -968,32 +1522,54 @@ def view_users(page: ft.Page):
 # MAIN ROUTER
 # ==============================================================================
 
+ROUTES = {
+    "/": view_login,
+    "/dashboard": view_dashboard,
+    "/curso": view_curso,
+    "/student_detail": view_student_detail,
+    "/form_student": view_form_student,
+    "/admin": view_admin,
+    "/ciclos": view_ciclos,
+    "/users": view_users
+}
+
+# Vistas de solo lectura que se pueden reusar al volver; los formularios se arman siempre de cero
+CACHEABLE_ROUTES = {"/dashboard", "/curso", "/student_detail", "/admin"}
+
 def main(page: ft.Page):
     page.title = "Asistencia UNSAM"
     page.theme_mode = ft.ThemeMode.LIGHT
     page.padding = 0
-
-    routes = {
-        "/": view_login,
-        "/dashboard": view_dashboard,
-        "/curso": view_curso,
-        "/student_detail": view_student_detail,
-        "/form_student": view_form_student,
-        "/admin": view_admin,
-        "/ciclos": view_ciclos,
-        "/users": view_users
-    }
+    if db.ready: db.start_listener()  # no al importar: sin DB, o desde scripts, no hay nada que escuchar
+
+    view_cache = {}  # ruta -> (etiqueta, vista), propio de esta sesión
+
+    def build_view(route):
+        view_fn = ROUTES.get(route, view_login)
+        if route not in CACHEABLE_ROUTES:
+            return view_fn(page)
+        # La vista sirve mientras no cambien los datos ni las claves de sesión que la definen
+        user = UIHelper.current_user(page)
+        label = (db.data_version, user['id'] if user else None, page.session.get("curso_id"), page.session.get("alumno_id"))
+        cached = view_cache.get(route)
+        if cached and cached[0] == label:
+            return cached[1]
+        errores = db.read_errors
+        view = view_fn(page)
+        if db.read_errors == errores:
+            view_cache[route] = (label, view)
+        else:
+            view_cache.pop(route, None)  # armada con lecturas fallidas: no se reutiliza
+        return view
 
     def route_change(route):
+        AttendanceService.flush()  # no dejar marcas pendientes al navegar
         page.views.clear()
-        if page.route != "/" and not page.session.get("user"):
+        if page.route != "/" and not UIHelper.current_user(page):
             page.route = "/"
         
-        view_fn = routes.get(page.route)
-        if view_fn:
-            page.views.append(view_fn(page))
-        else:
-            page.views.append(view_login(page))
+        with db.request_scope():  # todas las consultas de la vista en una sola conexión
+            page.views.append(build_view(page.route))
         page.update()
 
     def view_pop(view):
@@ -1003,9 +1579,12 @@ def main(page: ft.Page):
 
     page.on_route_change = route_change
     page.on_view_pop = view_pop
+    # Al cerrarse la pestaña o cortarse la sesión no se espera al hilo escritor
+    page.on_disconnect = lambda e: AttendanceService.flush()
     page.go("/")
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _sigterm_exit)
     port_env = os.environ.get("PORT")
     if port_env:
         ft.app(target=main, view=ft.AppView.WEB_BROWSER, port=int(port_env), host="0.0.0.0")